@@ -1,61 +1,201 @@
-from typing import Annotated, TypedDict, Sequence, Literal
+from typing import Annotated, TypedDict, Sequence, Literal, List, Union
+from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import cache, lru_cache
+import io
 import os
+import sqlite3
+import sys
+import time
 
+import aiosqlite
+import orjson
+import tiktoken
 from dotenv import load_dotenv
-from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.messages.ai import add_ai_message_chunks
+from langchain_openai import ChatOpenAI
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langchain_core.tools import tool
 from langgraph.graph.message import add_messages
 from langgraph.graph import StateGraph, END, START
+from langgraph.constants import TAG_NOSTREAM
 from langgraph.prebuilt import ToolNode
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langchain_chroma import Chroma
 
 
 from prompts.main_reply_prompt import get_main_reply_prompt
-from helper.supabase import get_user_inventory
+from helper.supabase import get_user_inventory, get_expiring_inventory
+from helper.embeddings import FaqIndex, get_embeddings, embed_query, normalize_query, faq_cache
+from helper.http_client import openai_http_client, openai_async_http_client
 
-load_dotenv()
 db_dir = "./chroma_db"
 collection_name = "ecobite_faq"
+faq_top_k = 5
+# Upper bound for expiring_inventory_retriever's within_days
+MAX_EXPIRY_WINDOW_DAYS = 365
 
 # --- CONFIGS ---
-@dataclass
+_dotenv_loaded = False
+
+def _load_dotenv():
+    """Loads .env once, on first use instead of at import time"""
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        load_dotenv()
+        _dotenv_loaded = True
+
+def _getenv(name: str, default: str) -> str:
+    _load_dotenv()
+    return os.getenv(name, default)
+
+@dataclass(frozen=True)
 class AgentConfig:
-    """Centralized configuration"""
-    model_name: str = field(default_factory=lambda: os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+    """Centralized configuration (frozen, so it can key create_tools' cache)"""
+    model_name: str = field(default_factory=lambda: _getenv("OPENAI_MODEL", "gpt-4o-mini"))
     temperature: float = 0.5
+    # Echo reply tokens to stdout as they arrive (CLI use; the server leaves this off)
+    stream_output: bool = False
+    # Coalesce streamed tokens and flush once either limit is reached
+    batch_chars: int = 64
+    batch_ms: int = 50
+    # Once the unsummarized history exceeds this many tokens, fold all but the
+    # last few messages into a rolling summary
+    history_token_limit: int = 3000
+    history_keep_messages: int = 6
 
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
     config: AgentConfig
+    # Rolling summary of messages[:summarized_count]; the full history stays in
+    # `messages` so /history is unaffected
+    summary: str
+    summarized_count: int
 
-embeddings = OpenAIEmbeddings(
-    model="text-embedding-3-small"
-)
-
-# Initialize Vector Store if available
-vectorStore = None
-retriever = None
+# --- VECTOR STORE ---
+@cache
+def _get_faq_index():
+    """
+    Loads the FAQ embeddings from Chroma into memory on first use; returns None
+    if the database is unavailable. Chroma is only read here, never per query.
+    """
+    if not (os.path.exists(db_dir) and os.listdir(db_dir)):
+        return None
 
-if os.path.exists(db_dir) and os.listdir(db_dir):
     print(f"--- Existing database found in {db_dir}. Loading... ---")
     try:
         vectorStore = Chroma(
             persist_directory=db_dir,
-            embedding_function=embeddings,
+            embedding_function=get_embeddings(),
             collection_name=collection_name
         )
-        retriever = vectorStore.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": 5}
-        )
+        index = FaqIndex.from_chroma(vectorStore)
     except Exception as e:
         print(f"⚠️ Warning: Could not load Chroma DB: {e}")
+        return None
+
+    # Drop cached answers computed against a different build of the collection
+    faq_cache.bind(index.fingerprint)
+    return index
+
+# --- STREAMING ---
+class TokenBuffer:
+    """Coalesces streamed tokens so stdout is flushed in batches instead of per token"""
+    def __init__(self, max_chars: int, max_ms: int):
+        self.max_chars = max_chars
+        self.max_wait = max_ms / 1000
+        # Start at one char so the first token shows immediately, then double per flush
+        self.threshold = 1
+        self.buffer = io.StringIO()
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, text: str):
+        self.buffer.write(text)
+        self.size += len(text)
+        now = time.monotonic()
+        if self.size >= self.threshold or now - self.last_flush >= self.max_wait:
+            self.flush(now)
+
+    def flush(self, now: float = None):
+        if self.size:
+            sys.stdout.write(self.buffer.getvalue())
+            sys.stdout.flush()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.size = 0
+            self.threshold = min(self.threshold * 2, self.max_chars)
+        self.last_flush = now if now is not None else time.monotonic()
+
+# --- HISTORY ---
+def utc_timestamp() -> str:
+    """Current UTC time as ISO-8601 with a Z suffix, used to stamp stored messages"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation so far in at most 300 tokens. Keep the user's "
+    "inventory facts, preferences and any open requests. Reply with the summary only."
+)
+
+@lru_cache(maxsize=8)
+def _get_encoding(model_name: str):
+    """
+    Returns the tiktoken encoding for a model, or None if it can't be loaded.
+    tiktoken downloads its BPE file on first use, so an unreachable host must not
+    fail the turn; the failure is cached and the count falls back to an estimate.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"⚠️ Warning: Could not load tiktoken encoding, estimating token counts: {e}")
+        return None
+
+def num_tokens_from_messages(messages: Sequence[BaseMessage], model_name: str) -> int:
+    """Approximate prompt size; ~4 tokens of per-message framing as in OpenAI's cookbook"""
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        # Roughly 4 characters per token for English text
+        return sum(4 + len(get_buffer_string([msg])) // 4 for msg in messages)
+    return sum(4 + len(encoding.encode(get_buffer_string([msg]))) for msg in messages)
+
+def warm_up(config: AgentConfig = None):
+    """
+    Loads what the first turn would otherwise load on demand: the token encoding
+    and the in-memory FAQ index. Blocking; servers should run it off the event
+    loop at startup.
+    """
+    if config is None:
+        config = AgentConfig()
+    _get_encoding(config.model_name)
+    _get_faq_index()
 
 # --- TOOLS ---
+@lru_cache(maxsize=1)
+def _format_minute(minute: int) -> str:
+    """Formats an epoch minute; cached so repeated calls within a minute are free"""
+    return datetime.fromtimestamp(minute * 60).strftime("%b %d, %Y %H:%M")
+
+def _format_faq_docs(query: str, docs) -> str:
+    if not docs:
+        return f"Didn't find relevant information about {query} in the EcoBite FAQ document."
+
+    results = []
+    for i, doc in enumerate(docs):
+        results.append(f"Source Document Chunk {i+1} (Page {doc.metadata.get('page', 'N/A')}):\n{doc.page_content}")
+
+    return "\n\n".join(results)
+
+def _config_user_id(config: RunnableConfig):
+    """The caller passes user_id via config["configurable"], keeping it out of the prompt"""
+    return (config or {}).get("configurable", {}).get("user_id")
+
+@lru_cache(maxsize=4)
 def create_tools(config: AgentConfig): 
     @tool(description=
         """
@@ -63,106 +203,248 @@ def create_tools(config: AgentConfig):
         'today's date', or 'what day is it'.
         """)
     def current_dateTime():
-        now = datetime.now()
-        return now.strftime("%b %d, %Y %H:%M")
+        return _format_minute(int(time.time() // 60))
 
     @tool(description=        
         """
         This tool searches and returns the information from the EcoBite FAQ document 
         to answer questions related to the app, features, donations, and usage.
+        Pass a list of queries to look up several questions in one call.
         """)
-    def ecobite_faq_retriever(query: str) -> str:
-        if not retriever:
+    def ecobite_faq_retriever(query: Union[str, List[str]]) -> str:
+        faq_index = _get_faq_index()
+        if not faq_index:
             return "FAQ database is currently unavailable."
-            
-        docs = retriever.invoke(query)
 
-        if not docs:
-            return f"Didn't find relevant information about {query} in the EcoBite FAQ document."
-        
-        results = []
-        for i, doc in enumerate(docs):
-            results.append(f"Source Document Chunk {i+1} (Page {doc.metadata.get('page', 'N/A')}):\n{doc.page_content}")
-        
-        return "\n\n".join(results)
+        queries = [query] if isinstance(query, str) else list(query)
+        keys = [normalize_query(q) for q in queries]
+
+        # Repeated questions are answered from the cache without touching OpenAI or Chroma
+        results = {key: faq_cache.get(key) for key in keys}
+        missing = [key for key, value in results.items() if value is None]
+
+        if len(missing) == 1:
+            vectors = [embed_query(missing[0])]
+        elif missing:
+            # One embeddings request for every uncached question in this call
+            vectors = get_embeddings().embed_documents(missing)
+        else:
+            vectors = []
+
+        for key, vector in zip(missing, vectors):
+            docs = faq_index.search(vector, k=faq_top_k)
+            results[key] = _format_faq_docs(key, docs)
+            faq_cache.put(key, results[key])
+
+        if isinstance(query, str):
+            return results[keys[0]]
+        return "\n\n".join(f"Results for \"{q}\":\n{results[key]}" for q, key in zip(queries, keys))
     
     @tool(description=
         """
         Retrieves the user's current inventory, including item names, quantities, and expiration dates.
         Use this tool when the user asks about:
         - what items they currently have
-        - what is expiring or near expiration
         - checking their stock or available ingredients
         - recipes or meal ideas based on inventory
-
-        Requires: user_id
         """)
-    def user_inventory_retriever(user_id: int) -> str:
+    def user_inventory_retriever(config: RunnableConfig) -> str:
+        user_id = _config_user_id(config)
+        if user_id is None:
+            return "No user is associated with this conversation."
+
         # Call the Supabase function
         items = get_user_inventory(user_id)
         
         if not items:
             return "The user's inventory is empty."
         
-        # Format the output so the LLM can read it easily
-        # Based on your table schema: item_name, quantity, unit, expiry_date
-        formatted_list = ["Current Inventory:"]
-        for item in items:
-            name = item.get("item_name", "Unknown")
-            qty = item.get("quantity", 0)
-            unit = item.get("unit", "")
-            expiry = item.get("expiry_date", "N/A")
-            formatted_list.append(f"- {name}: {qty} {unit} (Expires: {expiry})")
-            
-        return "\n".join(formatted_list)
-
-    return [current_dateTime, ecobite_faq_retriever, user_inventory_retriever]
+        # Compact JSON with short keys to keep the tool result small; the system
+        # prompt documents the keys. Rows already arrive with those keys (see INVENTORY_COLUMNS)
+        return orjson.dumps(items).decode()
+
+    @tool(description=
+        """
+        Retrieves only the user's items that are expired or expire within the next `within_days` days
+        (default 7), soonest first. Use this when the user asks what is expiring or which
+        items to use up first; use the full inventory for general recipe or meal requests.
+        """)
+    def expiring_inventory_retriever(config: RunnableConfig, within_days: int = 7) -> str:
+        user_id = _config_user_id(config)
+        if user_id is None:
+            return "No user is associated with this conversation."
+
+        # The model picks within_days; keep it to a range the date math and the answer make sense for
+        within_days = min(max(int(within_days), 0), MAX_EXPIRY_WINDOW_DAYS)
+        items = get_expiring_inventory(user_id, within_days)
+
+        if not items:
+            return f"Nothing in the user's inventory expires within {within_days} days."
+
+        # Same compact format as user_inventory_retriever
+        return orjson.dumps(items).decode()
+
+    # A tuple, since the cached result is shared by every graph built with this config
+    return (current_dateTime, ecobite_faq_retriever, user_inventory_retriever, expiring_inventory_retriever)
 
 # --- GRAPH BUILDER ---
+def _checkpoint_db_path() -> str:
+    return _getenv("CHECKPOINT_DB", "ecobite_ckpt.db")
+
+def create_sqlite_checkpointer(path: str = None) -> SqliteSaver:
+    """Local durable checkpointer; WAL keeps per-step checkpoint writes cheap"""
+    conn = sqlite3.connect(path or _checkpoint_db_path(), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return SqliteSaver(conn)
+
+@asynccontextmanager
+async def open_async_sqlite_checkpointer(path: str = None):
+    """Async counterpart of create_sqlite_checkpointer, for graphs driven by ainvoke/astream"""
+    async with aiosqlite.connect(path or _checkpoint_db_path()) as conn:
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        yield AsyncSqliteSaver(conn)
+
+def route_agent(state: AgentState) -> Literal["tools", "end"]:
+    # Tool messages have no tool_calls attribute, so use getattr rather than hasattr + access
+    return "tools" if getattr(state["messages"][-1], "tool_calls", None) else "end"
+
 def build_agent_graph(config: AgentConfig = None, checkpointer = None):
+    # Always, not only via AgentConfig defaults: ChatOpenAI reads OPENAI_API_KEY
+    # even when the caller passes every config value explicitly
+    _load_dotenv()
     if config is None:
         config = AgentConfig()
 
     # 1. Setup Tools and Model
     tools = create_tools(config)
-    model = ChatOpenAI(
+    llm = ChatOpenAI(
         model_name=config.model_name,
-        temperature=config.temperature
-    ).bind_tools(tools)
+        temperature=config.temperature,
+        # Report usage on streamed replies so prompt-cache hits show up in
+        # usage_metadata["input_token_details"]["cache_read"]
+        stream_usage=True,
+        http_client=openai_http_client,
+        http_async_client=openai_async_http_client
+    )
+    model = llm.bind_tools(tools)
+    # Summaries are internal; keep their tokens out of LangGraph's message stream
+    summarizer = llm.with_config(tags=[TAG_NOSTREAM])
 
-    # 2. Define Agent Node
-    def agent_node(state: AgentState):
-        messages = state["messages"]
-        
-        # Ensure System Prompt is always present
-        # Note: You might need to update your main_reply_prompt to mention the new inventory capability
-        system_prompt_content = get_main_reply_prompt(tools[1].name, tools[2].name)
-        system_prompt = SystemMessage(content=system_prompt_content)
-        
-        # Filter out previous system messages to avoid stacking them
-        filtered_messages = [msg for msg in messages if not isinstance(msg, SystemMessage)]
-        
-        all_messages = [system_prompt] + filtered_messages
+    # Build the system prompt once per graph; agent_node reuses the same message.
+    # It must stay byte-identical and first in every request so OpenAI's prompt
+    # cache can reuse the prefix across turns (keep timestamps etc. out of it)
+    system_prompt = SystemMessage(content=get_main_reply_prompt(tools[1].name, tools[2].name, tools[3].name))
+
+    # 2. Define Summarize Node
+    def plan_summary(state: AgentState):
+        """Returns (start, cut) when messages[start:start + cut] should be summarized"""
+        start = state.get("summarized_count") or 0
+        window = state["messages"][start:]
+        if num_tokens_from_messages(window, config.model_name) <= config.history_token_limit:
+            return None
+
+        # Keep the last few messages raw, cutting on a user turn so tool calls
+        # and their results are never split apart
+        cut = len(window) - config.history_keep_messages
+        while cut > 0 and not isinstance(window[cut], HumanMessage):
+            cut -= 1
+        if cut <= 0:
+            return None
+        return start, cut
+
+    def summary_request(state: AgentState, start: int, cut: int):
+        transcript = get_buffer_string(state["messages"][start:start + cut], human_prefix="User", ai_prefix="Assistant")
+        if state.get("summary"):
+            transcript = f"Earlier summary:\n{state['summary']}\n\n{transcript}"
+        return [SystemMessage(content=SUMMARY_INSTRUCTIONS), HumanMessage(content=transcript)]
+
+    def route_start(state: AgentState) -> Literal["summarize", "agent"]:
+        return "summarize" if plan_summary(state) else "agent"
+
+    def summarize_node(state: AgentState):
+        plan = plan_summary(state)
+        if plan is None:
+            return {}
+        start, cut = plan
+        summary = summarizer.invoke(summary_request(state, start, cut))
+        return {"summary": summary.content, "summarized_count": start + cut}
+
+    async def asummarize_node(state: AgentState):
+        plan = plan_summary(state)
+        if plan is None:
+            return {}
+        start, cut = plan
+        summary = await summarizer.ainvoke(summary_request(state, start, cut))
+        return {"summary": summary.content, "summarized_count": start + cut}
+
+    # 3. Define Agent Node
+    def build_request(state: AgentState):
+        # System messages are never written to state (the prompt and summary are
+        # added here per request), so history can be passed through without filtering
+        messages = state["messages"][state.get("summarized_count") or 0:]
         
-        response = model.invoke(all_messages)
+        # System prompt first (the cacheable prefix), then the summary and recent history
+        request = [system_prompt]
+        if state.get("summary"):
+            request.append(SystemMessage(content=f"Summary of the earlier conversation:\n{state['summary']}"))
+        request.extend(messages)
+        return request
+
+    def merge_chunks(chunks):
+        # Merge the chunks back into one message in a single pass (chaining `+`
+        # builds and validates a new message per token); tool_calls are rebuilt
+        # from the chunks
+        response = add_ai_message_chunks(chunks[0], *chunks[1:])
+        # Not sent back to OpenAI; lets /history show when the reply was written
+        response.additional_kwargs["timestamp"] = utc_timestamp()
         return {"messages": [response]}
 
-    # 3. Define Routing Logic
-    def route_agent(state: AgentState) -> Literal["tools", "end"]:
-        messages = state["messages"]
-        last_message = messages[-1]
-        
-        if last_message.tool_calls:
-            return "tools"
-        return "end"
+    def agent_node(state: AgentState):
+        # Stream the reply so tokens reach the caller (stdout or LangGraph's
+        # "messages" stream mode) as soon as they are generated
+        chunks = []
+        out = TokenBuffer(config.batch_chars, config.batch_ms) if config.stream_output else None
+        for chunk in model.stream(build_request(state)):
+            if out and chunk.content:
+                out.write(chunk.content)
+            chunks.append(chunk)
+        if out:
+            out.flush()
+        return merge_chunks(chunks)
+
+    async def aagent_node(state: AgentState):
+        # Same as agent_node, but awaits the model so ainvoke/astream callers
+        # don't tie up a worker thread for the whole generation
+        chunks = []
+        out = TokenBuffer(config.batch_chars, config.batch_ms) if config.stream_output else None
+        async for chunk in model.astream(build_request(state)):
+            if out and chunk.content:
+                out.write(chunk.content)
+            chunks.append(chunk)
+        if out:
+            out.flush()
+        return merge_chunks(chunks)
 
     # 4. Build the Graph
     graph = StateGraph(AgentState)
     
-    graph.add_node("agent", agent_node)
+    graph.add_node("summarize", RunnableLambda(summarize_node, afunc=asummarize_node))
+    graph.add_node("agent", RunnableLambda(agent_node, afunc=aagent_node))
     graph.add_node("tools", ToolNode(tools=tools))
 
-    graph.add_edge(START, "agent")
+    # Only detour through summarize when a summary is due, so ordinary turns
+    # don't pay for an extra step (and its checkpoint write)
+    graph.add_conditional_edges(
+        START,
+        route_start,
+        {
+            "summarize": "summarize",
+            "agent": "agent"
+        }
+    )
+    graph.add_edge("summarize", "agent")
     
     graph.add_conditional_edges(
         "agent",
@@ -176,6 +458,6 @@ def build_agent_graph(config: AgentConfig = None, checkpointer = None):
 
     # 5. Persistence Strategy
     if checkpointer is None:
-        checkpointer = MemorySaver()
+        checkpointer = create_sqlite_checkpointer()
     
     return graph.compile(checkpointer=checkpointer)
\ No newline at end of file
@@ -0,0 +1,166 @@
+import atexit
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import cache, lru_cache
+from typing import List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+from langchain_openai import OpenAIEmbeddings
+
+from helper.http_client import openai_http_client, openai_async_http_client
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+QUERY_CACHE_PATH = "./chroma_db/query_cache.pkl"
+QUERY_CACHE_SIZE = 512
+
+@cache
+def get_embeddings() -> OpenAIEmbeddings:
+    """
+    Creates the shared embeddings client on first use, so importing this module
+    needs neither a .env file nor an OpenAI key.
+    """
+    # Load environment variables from .env file
+    load_dotenv()
+    return OpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        http_client=openai_http_client,
+        http_async_client=openai_async_http_client
+    )
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_query(query: str) -> str:
+    """
+    Lowercases a query and collapses its whitespace so equivalent questions
+    share the same cache entries.
+    """
+    return _WHITESPACE.sub(" ", query).strip().lower()
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def embed_query(normalized_query: str) -> List[float]:
+    """
+    Embeds a normalized query, skipping the OpenAI round-trip for repeated queries.
+    The returned list is shared between callers and must not be mutated.
+    """
+    return get_embeddings().embed_query(normalized_query)
+
+class FaqIndex:
+    """
+    Exact in-memory nearest-neighbour search over the FAQ chunks. The corpus is a
+    handful of chunks, so one matrix-vector product beats an HNSW lookup and keeps
+    Chroma off the query path entirely.
+    """
+    def __init__(self, vectors, documents: List[Document], fingerprint: Optional[str] = None):
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(documents), -1) if documents else np.zeros((0, 0), dtype=np.float32)
+        # Normalize once so a dot product gives cosine similarity (same ranking as
+        # Chroma's l2 on OpenAI's unit-length embeddings)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix / np.where(norms == 0, 1, norms)
+        self.documents = documents
+        # Identifies the collection this index was built from (see QueryCache.bind)
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_chroma(cls, store) -> "FaqIndex":
+        """Loads every stored embedding and chunk from a langchain Chroma store"""
+        data = store.get(include=["embeddings", "documents", "metadatas"])
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data["documents"], data["metadatas"])
+        ]
+        # Chunk count plus ids; rebuilding the collection assigns new ids
+        ids = sorted(data["ids"])
+        fingerprint = hashlib.sha256(f"{len(ids)}:{','.join(ids)}".encode()).hexdigest()
+        return cls(data["embeddings"], documents, fingerprint)
+
+    def search(self, vector: List[float], k: int) -> List[Document]:
+        if not self.documents:
+            return []
+        scores = self.matrix @ np.asarray(vector, dtype=np.float32)
+        k = min(k, len(self.documents))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.documents[i] for i in top]
+
+class QueryCache:
+    """
+    Thread-safe LRU mapping normalized queries to formatted tool results,
+    persisted to disk with pickle so it survives restarts. Entries are tied to
+    the FAQ collection they came from and dropped when it changes (see bind).
+    """
+    def __init__(self, path: str, maxsize: int):
+        self.path = path
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+        self._fingerprint: Optional[str] = None
+        self._loaded_fingerprint: Optional[str] = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def bind(self, fingerprint: str):
+        """
+        Ties the cache to the loaded FAQ collection; entries saved for a different
+        collection (e.g. before a Chroma rebuild) are discarded.
+        """
+        with self._lock:
+            if self._loaded_fingerprint != fingerprint:
+                self._data.clear()
+            self._fingerprint = fingerprint
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def save(self):
+        with self._lock:
+            snapshot = OrderedDict(self._data)
+            fingerprint = self._fingerprint
+        directory = os.path.dirname(self.path)
+        if not snapshot or fingerprint is None or not os.path.isdir(directory):
+            return
+        tmp_path = None
+        try:
+            # A temp file per process, since every uvicorn worker saves at exit
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".query_cache.", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump({"fingerprint": fingerprint, "entries": snapshot}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Warning: Could not save query cache: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            # Runs at import time; a corrupt file is just a cold cache
+            print(f"⚠️ Warning: Could not load query cache: {e}")
+            return
+        if isinstance(data, dict) and isinstance(data.get("entries"), OrderedDict):
+            self._data = data["entries"]
+            self._loaded_fingerprint = data.get("fingerprint")
+
+# Cache of FAQ retriever results, keyed on the normalized query
+faq_cache = QueryCache(QUERY_CACHE_PATH, QUERY_CACHE_SIZE)
+atexit.register(faq_cache.save)
@@ -0,0 +1,9 @@
+import httpx
+
+# Shared HTTP/2 keep-alive clients for OpenAI (chat + embeddings) so DNS/TLS
+# setup is paid once per process instead of per request. Supabase keeps its
+# own session: postgrest writes its apikey headers onto the client it is given.
+_limits = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+openai_http_client = httpx.Client(http2=True, timeout=30, limits=_limits)
+openai_async_http_client = httpx.AsyncClient(http2=True, timeout=30, limits=_limits)
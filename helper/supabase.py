@@ -1,39 +1,180 @@
 import os
+import threading
+from datetime import date, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache
 from typing import List, Dict, Any
+from cachetools import TTLCache
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+@cache
+def get_supabase_client() -> Client:
+    """
+    Creates the shared Supabase client on first use, so importing this module
+    doesn't require Supabase credentials.
+    """
+    # Load environment variables from .env file
+    load_dotenv()
+
+    url: str = os.getenv("SUPABASE_URL")
+    key: str = os.getenv("SUPABASE_KEY")
+
+    if not url or not key:
+        print("❌ Missing Supabase environment variables!")
+        raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY environment variables")
+
+    client = create_client(url, key)
+    print("✅ Supabase client initialized")
+    return client
 
-url: str = os.getenv("SUPABASE_URL")
-key: str = os.getenv("SUPABASE_KEY")
+# Only the columns the agent actually reads, renamed by PostgREST to the short
+# keys the agent sends to the model (n = item_name, q = quantity, u = unit,
+# e = expiry_date), so rows can be serialized as-is
+INVENTORY_COLUMNS = "n:item_name,q:quantity,u:unit,e:expiry_date"
 
-if not url or not key:
-    print("❌ Missing Supabase environment variables!")
-    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY environment variables")
+# Per-user inventory cache; short TTL so out-of-band edits still show up quickly
+_inventory_cache: TTLCache = TTLCache(maxsize=1024, ttl=30)
+_inventory_lock = threading.Lock()
+# Background fetches started by prefetch_user_inventory, keyed by user_id
+_inventory_inflight: Dict[int, Future] = {}
+# Bumped on invalidation so fetches that started earlier don't cache stale rows
+_inventory_generation: Dict[int, int] = {}
+# Expiring-items cache, keyed by (user_id, within_days)
+_expiring_cache: TTLCache = TTLCache(maxsize=1024, ttl=30)
+_prefetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="inventory-prefetch")
+
+def _fetch_user_inventory(user_id: int) -> List[Dict[str, Any]]:
+    with _inventory_lock:
+        generation = _inventory_generation.get(user_id, 0)
+
+    supabase = get_supabase_client()
+    try:
+        # Query the 'inventory' table: select the needed columns where user_id matches
+        response = supabase.table("inventory").select(INVENTORY_COLUMNS).eq("user_id", user_id).execute()
+    except Exception as e:
+        print(f"❌ Error fetching inventory: {e}")
+        return []
 
-# Create and export the Supabase client
-supabase: Client = create_client(url, key)
+    with _inventory_lock:
+        if _inventory_generation.get(user_id, 0) == generation:
+            _inventory_cache[user_id] = response.data
 
-print("✅ Supabase client initialized")
+    # Return the list of data (rows)
+    return response.data
 
 def get_user_inventory(user_id: int) -> List[Dict[str, Any]]:
     """
     Fetches the inventory for a specific user from the 'inventory' table.
+    Results are cached per user for 30 seconds; failed lookups are not cached.
+    If a prefetch for the user is still running, waits for it instead of querying again.
     
     Args:
         user_id (int): The foreign key ID of the user.
         
     Returns:
-        List[Dict[str, Any]]: A list of inventory items (dictionaries).
+        List[Dict[str, Any]]: A list of inventory items with keys n, q, u and e.
     """
-    try:
-        # Query the 'inventory' table: select all columns where user_id matches
-        response = supabase.table("inventory").select("*").eq("user_id", user_id).execute()
+    with _inventory_lock:
+        cached = _inventory_cache.get(user_id)
+        pending = _inventory_inflight.get(user_id)
+    if cached is not None:
+        return cached
+    if pending is not None:
+        return pending.result()
+    return _fetch_user_inventory(user_id)
+
+def prefetch_user_inventory(user_id: int) -> None:
+    """
+    Starts loading a user's inventory in the background, so the lookup overlaps
+    with the model deciding whether it needs it. Does nothing if the inventory
+    is already cached or being fetched.
+    
+    Args:
+        user_id (int): The foreign key ID of the user.
+    """
+    with _inventory_lock:
+        if user_id in _inventory_cache or user_id in _inventory_inflight:
+            return
+        future = _prefetch_pool.submit(_fetch_user_inventory, user_id)
+        _inventory_inflight[user_id] = future
+
+    def _done(f: Future):
+        with _inventory_lock:
+            if _inventory_inflight.get(user_id) is f:
+                del _inventory_inflight[user_id]
+
+    future.add_done_callback(_done)
+
+def _filter_expiring(items: List[Dict[str, Any]], cutoff: str) -> List[Dict[str, Any]]:
+    # Same result as the Postgres filter below: rows without an expiry are skipped
+    expiring = [item for item in items if item.get("e") is not None and item["e"] <= cutoff]
+    expiring.sort(key=lambda item: item["e"])
+    return expiring
+
+def get_expiring_inventory(user_id: int, within_days: int = 7) -> List[Dict[str, Any]]:
+    """
+    Fetches a user's items that expire within the given number of days (including
+    already-expired ones), soonest first. If the full inventory is cached or being
+    prefetched, it is filtered locally; otherwise the filter and sort run in Postgres
+    so only the matching rows are returned. Cached like get_user_inventory.
+    
+    Args:
+        user_id (int): The foreign key ID of the user.
+        within_days (int): How many days ahead of today to include.
         
-        # Return the list of data (rows)
-        return response.data
+    Returns:
+        List[Dict[str, Any]]: A list of inventory items with keys n, q, u and e.
+    """
+    cache_key = (user_id, within_days)
+    with _inventory_lock:
+        cached = _expiring_cache.get(cache_key)
+        full = _inventory_cache.get(user_id)
+        pending = _inventory_inflight.get(user_id)
+        generation = _inventory_generation.get(user_id, 0)
+    if cached is not None:
+        return cached
+
+    cutoff = (date.today() + timedelta(days=within_days)).isoformat()
+
+    if full is None and pending is not None:
+        pending.result()
+        # Failed fetches aren't cached, so only use the prefetch if it landed
+        with _inventory_lock:
+            full = _inventory_cache.get(user_id)
+    if full is not None:
+        return _filter_expiring(full, cutoff)
+
+    supabase = get_supabase_client()
+    try:
+        response = (
+            supabase.table("inventory")
+            .select(INVENTORY_COLUMNS)
+            .eq("user_id", user_id)
+            .lte("expiry_date", cutoff)
+            .order("expiry_date")
+            .execute()
+        )
     except Exception as e:
-        print(f"❌ Error fetching inventory: {e}")
-        return []
\ No newline at end of file
+        print(f"❌ Error fetching expiring inventory: {e}")
+        return []
+
+    with _inventory_lock:
+        if _inventory_generation.get(user_id, 0) == generation:
+            _expiring_cache[cache_key] = response.data
+
+    return response.data
+
+def invalidate_user_inventory(user_id: int) -> None:
+    """
+    Drops the cached inventory for a user. Call this after any write to their inventory.
+    
+    Args:
+        user_id (int): The foreign key ID of the user.
+    """
+    with _inventory_lock:
+        _inventory_cache.pop(user_id, None)
+        _inventory_inflight.pop(user_id, None)
+        for cache_key in [k for k in _expiring_cache.keys() if k[0] == user_id]:
+            _expiring_cache.pop(cache_key, None)
+        _inventory_generation[user_id] = _inventory_generation.get(user_id, 0) + 1
@@ -1,5 +1,9 @@
-def get_main_reply_prompt(ecobite_faq_retriever: str, inventory_retriever: str) -> str:
-    return f"""
+from functools import lru_cache
+from string import Template
+
+
+# Compiled once at import; tool names are substituted into the $-placeholders
+_MAIN_REPLY_TEMPLATE = Template("""
 ECOBITE ASSISTANT — SYSTEM GUIDELINES
 
 ROLE AND IDENTITY
@@ -17,29 +21,32 @@ Use current_dateTime when:
 2. FAQ Tool (for EcoBite app questions)
 When the user asks about EcoBite features, automations, app behavior, or settings,
 always first try to answer using:
-{ecobite_faq_retriever}
+${faq}
 
-3. Inventory Tool (high priority usage)
-You must call {inventory_retriever} when the user asks anything involving inventory, such as:
+3. Inventory Tools (high priority usage)
+${inv} returns the full inventory. ${expiring} returns only items that are expired or expiring soon, soonest first.
+Both return a JSON array of items: n = item name, q = quantity, u = unit, e = expiry date.
+You must call one of them when the user asks anything involving inventory, such as:
 
-A. Checking ingredients
+A. Checking ingredients (use ${inv})
 - "What’s in my inventory?"
 - "Ano pang meron ako?"
 - "Do I still have chicken?"
 - "Show me my ingredients"
 
-B. Checking expiration
+B. Checking expiration (use ${expiring})
 - "What’s expiring soon?"
 - "May expired ba?"
 - "Anong ingredients ang kailangan gamitin ASAP?"
 - "Which items are at risk?"
 
-C. Recipes or meal requests
+C. Recipes or meal requests (use ${inv})
 - "What can I cook?"
 - "Bigyan mo ako recipe"
 - "Paano ko uubusin ang — ?"
 - "Give me meal ideas based on my ingredients"
-Any recipe suggestion must be based on real expiring inventory. Always use the tool first.
+Only when the user asks to use up expiring items first (e.g. "What should I cook before it spoils?"), use ${expiring} instead.
+Any recipe suggestion must be based on real inventory, prioritizing items that expire soonest. Always use the tool first.
 
 D. Waste management decisions
 Any guidance on storing, cooking, or donating items currently in inventory should use the tool to check real data.
@@ -136,4 +143,13 @@ Each response must guide the user toward a clear next step:
 - donate this
 - check dashboard
 - update inventory
-"""
\ No newline at end of file
+""")
+
+
+@lru_cache(maxsize=8)
+def get_main_reply_prompt(ecobite_faq_retriever: str, inventory_retriever: str, expiring_inventory_retriever: str) -> str:
+    return _MAIN_REPLY_TEMPLATE.substitute(
+        faq=ecobite_faq_retriever,
+        inv=inventory_retriever,
+        expiring=expiring_inventory_retriever
+    )
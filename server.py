@@ -1,48 +1,84 @@
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 from fastapi import FastAPI, HTTPException, Security, Depends, status, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import APIKeyHeader
-from pydantic import BaseModel, Field
-from langchain_core.messages import HumanMessage, AIMessage
-from ecobiteAgent import build_agent_graph
+from pydantic import BaseModel, ConfigDict, Field
+from langchain_core.messages import HumanMessage, HumanMessageChunk, AIMessage, AIMessageChunk
+from ecobiteAgent import build_agent_graph, open_async_sqlite_checkpointer, utc_timestamp, warm_up
+from helper.supabase import prefetch_user_inventory
 
 # Rate Limiting Imports
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 
 # Postgres / Supabase Imports
-from langgraph.checkpoint.postgres import PostgresSaver
-from psycopg_pool import ConnectionPool
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from psycopg_pool import AsyncConnectionPool
 import uvicorn
+import asyncio
+import orjson
+import hmac
 import os
-from datetime import datetime, timezone
+import re
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # --- RATE LIMITER SETUP (FIXED FOR RAILWAY/CLOUD) ---
 def get_real_ip(request: Request):
+    # Parsed once per request; the limiter may ask several times
+    ip = getattr(request.state, "real_ip", None)
+    if ip:
+        return ip
+
     forwarded = request.headers.get("X-Forwarded-For")
     if forwarded:
         # The first IP in the list is the real client
-        return forwarded.split(",")[0]
-    # Fallback to direct connection (useful for local testing)
-    return request.client.host or "127.0.0.1"
+        ip = forwarded.partition(",")[0].strip()
+    else:
+        # Fallback to direct connection (useful for local testing)
+        ip = request.client.host or "127.0.0.1"
+    request.state.real_ip = ip
+    return ip
 
-limiter = Limiter(key_func=get_real_ip)
+def get_user_key(request: Request):
+    # Per-user bucket for chat, so users behind one carrier NAT don't share it;
+    # user_id is stashed by bind_chat_request. user_id comes from the request body
+    # and isn't authenticated, so chat routes also keep a per-IP backstop limit.
+    user_id = getattr(request.state, "user_id", None)
+    if user_id is None:
+        return get_real_ip(request)
+    return f"user:{user_id}"
+
+# Per-IP cap on chat routes; looser than the per-user limit so a shared NAT IP
+# still has room, but rotating user_id can't bypass it. /chat and /chat/stream
+# share both buckets (shared_limit scopes), so switching routes doesn't reset them
+CHAT_IP_LIMIT = "30/minute"
+
+# Counters live in Redis so the limits hold across all uvicorn workers;
+# without REDIS_URL each worker keeps its own in-memory counters
+limiter = Limiter(
+    key_func=get_real_ip,
+    storage_uri=os.getenv("REDIS_URL", "memory://"),
+    strategy="moving-window"
+)
 
 # --- SECURITY SETUP ---
 API_KEY_NAME = "X-API-Key"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
 SERVER_API_KEY = os.getenv("ECOBITE_API_KEY")
 
+# Fail at startup rather than on every request when the key isn't configured
+if not SERVER_API_KEY:
+    print("❌ Missing ECOBITE_API_KEY environment variable!")
+    raise ValueError("Missing ECOBITE_API_KEY environment variable")
+
+_SERVER_API_KEY_BYTES = SERVER_API_KEY.encode()
+
 async def get_api_key(api_key_header: str = Security(api_key_header)):
-    if not SERVER_API_KEY:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Server API Key configuration is missing"
-        )
-    if api_key_header != SERVER_API_KEY:
+    # Constant-time comparison so response timing doesn't leak how much of the key matched
+    if not hmac.compare_digest(api_key_header.encode(), _SERVER_API_KEY_BYTES):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Could not validate credentials"
@@ -51,56 +87,90 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
 
 # --- DATABASE SETUP ---
 DB_URI = os.getenv("DATABASE_URL")
-agent_app = None
+# Worker processes per instance. The default is capped because cpu_count on
+# shared cloud hosts reports the host's cores, not the container's share
+MAX_DEFAULT_WORKERS = 4
+WORKERS = int(os.getenv("WEB_CONCURRENCY") or min(os.cpu_count() or 2, MAX_DEFAULT_WORKERS))
+# Total Postgres connections for this instance. Each worker gets its own pool,
+# so the budget is split between them to stay under the Supabase pooler limit
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "60"))
+DB_POOL_MAX = max(1, DB_CONNECTION_BUDGET // WORKERS)
+if DB_POOL_MAX * WORKERS > DB_CONNECTION_BUDGET:
+    print(f"⚠️ {WORKERS} workers exceed DB_CONNECTION_BUDGET={DB_CONNECTION_BUDGET}; using 1 connection per worker")
+# Connections kept open per worker so requests after an idle period skip the TCP/TLS/auth handshake
+DB_POOL_MIN = min(int(os.getenv("DB_POOL_MIN", "2")), DB_POOL_MAX)
+
+@asynccontextmanager
+async def open_postgres_checkpointer():
+    """
+    Opens the async Postgres pool and checkpointer. The pool is closed on exit,
+    including when setup fails.
+    """
+    # SSL Mode is required for Supabase/Cloud Postgres
+    conn_kwargs = {
+        "sslmode": "require",
+        "autocommit": True,
+        "prepare_threshold": None,
+        "keepalives": 1,
+        "keepalives_idle": 5,
+        "keepalives_interval": 2,
+        "keepalives_count": 5
+    }
+
+    # Async pool + saver so checkpoint I/O doesn't block the event loop
+    async with AsyncConnectionPool(
+        conninfo=DB_URI, 
+        max_size=DB_POOL_MAX, 
+        min_size=DB_POOL_MIN, 
+        max_lifetime=1800, 
+        kwargs=conn_kwargs,
+        # Ping each connection before handing it out; Supabase's pooler drops idle ones silently
+        check=AsyncConnectionPool.check_connection,
+        open=False
+    ) as pool:
+        # Block startup until the warm connections exist rather than paying for them on the first request
+        await pool.wait(timeout=10)
+        checkpointer = AsyncPostgresSaver(pool)
+        await checkpointer.setup()
+        yield checkpointer
+    print("🛑 Disconnected from Supabase")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global agent_app
-    if DB_URI:
-        try:
-            # SSL Mode is required for Supabase/Cloud Postgres
-            conn_kwargs = {
-                "sslmode": "require",
-                "autocommit": True,
-                "prepare_threshold": None,
-                "keepalives": 1,
-                "keepalives_idle": 5,
-                "keepalives_interval": 2,
-                "keepalives_count": 5
-            }
-            
-            pool = ConnectionPool(
-                conninfo=DB_URI, 
-                max_size=20, 
-                min_size=0, 
-                max_lifetime=300, 
-                kwargs=conn_kwargs
-            )
-            
-            checkpointer = PostgresSaver(pool)
-            checkpointer.setup()
-            
-            print("✅ Connected to Supabase (Postgres) with Robust Pool")
-            agent_app = build_agent_graph(checkpointer=checkpointer)
-            yield
-            
-            pool.close()
-            print("🛑 Disconnected from Supabase")
-        except Exception as e:
-            print(f"❌ Database connection failed: {e}")
-            print("⚠️ Switching to IN-MEMORY storage")
-            agent_app = build_agent_graph() 
-            yield
-    else:
-        print("⚠️ No DATABASE_URL set. Using in-memory storage.")
-        agent_app = build_agent_graph()
+    async with AsyncExitStack() as stack:
+        checkpointer = None
+        if DB_URI:
+            try:
+                checkpointer = await stack.enter_async_context(open_postgres_checkpointer())
+                print("✅ Connected to Supabase (Postgres) with Robust Pool")
+            except Exception as e:
+                print(f"❌ Database connection failed: {e}")
+                print("⚠️ Switching to local SQLite storage")
+        else:
+            print("⚠️ No DATABASE_URL set. Using local SQLite storage.")
+
+        if checkpointer is None:
+            checkpointer = await stack.enter_async_context(open_async_sqlite_checkpointer())
+
+        # Kept on app.state rather than a module global, so each app instance owns its graph
+        app.state.agent = build_agent_graph(checkpointer=checkpointer)
+        # Load the token encoding and FAQ index now, so the first chat or FAQ
+        # question in each worker doesn't wait on them
+        await asyncio.to_thread(warm_up)
         yield
 
+# No /docs, /redoc or /openapi.json in production: less per-worker memory and
+# nothing for scanners to trigger a schema build on
+IS_PROD = os.getenv("ENV") == "prod"
+
 app = FastAPI(
     title="EcoBite Agent API", 
     version="1.5", 
+    docs_url=None if IS_PROD else "/docs",
+    redoc_url=None if IS_PROD else "/redoc",
+    openapi_url=None if IS_PROD else "/openapi.json",
     lifespan=lifespan,
-    dependencies=[Depends(get_api_key)] 
+    dependencies=[Depends(get_api_key)]
 )
 
 # --- CORS MIDDLEWARE (Crucial for Web/Mobile access) ---
@@ -120,97 +190,192 @@ app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 # --- STRICT INPUT VALIDATION ---
+THREAD_ID_PATTERN = r"^[A-Za-z0-9_\-]{1,100}$"
+THREAD_ID_RE = re.compile(THREAD_ID_PATTERN)
+
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, str_strip_whitespace=True)
+
     message: str = Field(..., max_length=2000, min_length=1)
-    thread_id: str = Field(..., max_length=100)
+    thread_id: str = Field(..., pattern=THREAD_ID_PATTERN)
     user_id: int
 
 class ChatResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     response: str
     thread_id: str
 
+def bind_chat_request(request: Request, chat_req: ChatRequest) -> ChatRequest:
+    """Parses the chat body and exposes user_id to the rate limiter's key function"""
+    request.state.user_id = chat_req.user_id
+    return chat_req
+
+def prepare_chat_turn(chat_req: ChatRequest):
+    """Builds the graph config and user message for one chat turn"""
+    config = {
+        "configurable": {
+            "thread_id": chat_req.thread_id,
+            "user_id": chat_req.user_id 
+        }
+    }
+    
+    # user_id reaches the inventory tools through config["configurable"], so the
+    # message is stored and sent to the model as typed
+    user_message = HumanMessage(
+        content=chat_req.message,
+        additional_kwargs={"timestamp": utc_timestamp()}
+    )
+
+    # Both inventory tools read from this fetch, so an inventory question doesn't
+    # wait on Supabase after the model decides to call one. Skipped while the
+    # user's inventory is still cached, so it costs at most one query per 30s
+    prefetch_user_inventory(chat_req.user_id)
+    return config, user_message
+
+def sse_event(data: str, event: str = None) -> str:
+    """Formats one Server-Sent Event; multi-line data gets one data: field per line"""
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
 @app.post("/chat", response_model=ChatResponse)
-@limiter.limit("5/minute")
-def chat_endpoint(request: Request, chat_req: ChatRequest):
-    global agent_app
+@limiter.shared_limit("5/minute", scope="chat", key_func=get_user_key)
+@limiter.shared_limit(CHAT_IP_LIMIT, scope="chat-ip")
+async def chat_endpoint(request: Request, chat_req: ChatRequest = Depends(bind_chat_request)):
+    agent = request.app.state.agent
     try:
-        config = {
-            "configurable": {
-                "thread_id": chat_req.thread_id,
-                "user_id": chat_req.user_id 
-            }
-        }
-        
-        # Inject user_id into context
-        context_aware_message = f"User ID: {chat_req.user_id}\n\n{chat_req.message}"
-        user_message = HumanMessage(content=context_aware_message)
+        config, user_message = prepare_chat_turn(chat_req)
         
-        output = agent_app.invoke(
+        output = await agent.ainvoke(
             {"messages": [user_message]},
             config=config
         )
         
         last_message = output["messages"][-1]
         
-        return ChatResponse(
-            response=last_message.content,
-            thread_id=chat_req.thread_id
-        )
+        # A plain dict; FastAPI serializes it through response_model=ChatResponse
+        return {
+            "response": last_message.content,
+            "thread_id": chat_req.thread_id
+        }
     except Exception as e:
         print(f"🔥 Chat Error: {e}")
         raise HTTPException(status_code=500, detail="Internal processing error")
 
+@app.post("/chat/stream")
+@limiter.shared_limit("5/minute", scope="chat", key_func=get_user_key)
+@limiter.shared_limit(CHAT_IP_LIMIT, scope="chat-ip")
+async def chat_stream_endpoint(request: Request, chat_req: ChatRequest = Depends(bind_chat_request)):
+    """Same as /chat, but streams the reply as Server-Sent Events while it is generated"""
+    agent = request.app.state.agent
+    config, user_message = prepare_chat_turn(chat_req)
+
+    async def event_stream():
+        try:
+            async for event in agent.astream_events(
+                {"messages": [user_message]},
+                config=config,
+                version="v2"
+            ):
+                # Only the user-facing reply; skip summaries and tool-call deltas
+                if event["event"] != "on_chat_model_stream" or event["metadata"].get("langgraph_node") != "agent":
+                    continue
+                content = event["data"]["chunk"].content
+                if content:
+                    yield sse_event(content)
+            yield sse_event(chat_req.thread_id, event="done")
+        except Exception as e:
+            print(f"🔥 Chat Stream Error: {e}")
+            yield sse_event("Internal processing error", event="error")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+# Exact-type lookup instead of isinstance chains; tool and system messages are not shown
+MESSAGE_TYPES = {
+    HumanMessage: "user",
+    HumanMessageChunk: "user",
+    AIMessage: "ai",
+    AIMessageChunk: "ai",
+}
+
+# Flush threshold for the streamed /history body
+HISTORY_CHUNK_BYTES = 64 * 1024
+
+async def iter_history_json(messages):
+    """
+    Yields the /history body ({"messages": [...]}) as it is encoded, one orjson
+    dump per message appended to a buffer, instead of building the full list of
+    dicts and encoding it afterwards.
+    """
+    # Fallback for messages stored before timestamps were recorded; computed once, not per message
+    now_iso = utc_timestamp()
+    # Local aliases: one LOAD_FAST per message instead of a global + attribute lookup
+    message_type = MESSAGE_TYPES.get
+    dumps = orjson.dumps
+
+    buffer = bytearray(b'{"messages":[')
+    separator = b""
+    for msg in messages:
+        msg_type = message_type(type(msg))
+        if msg_type is None:
+            continue 
+        
+        content = msg.content
+        # Clean up System Injections (threads from before user_id moved into the config)
+        if msg_type == "user" and isinstance(content, str) and content.startswith("User ID:"):
+            # The content format is "User ID: 123\n\nActual Message"
+            # We split by the first double newline to get the real message
+            parts = content.split("\n\n", 1)
+            if len(parts) > 1:
+                content = parts[1]
+            # If split fails, we keep original content (fallback)
+
+        buffer += separator
+        buffer += dumps({
+            "id": str(getattr(msg, "id", "")),
+            "type": msg_type,
+            "message": content,
+            "timestamp": msg.additional_kwargs.get("timestamp", now_iso)
+        })
+        separator = b","
+
+        if len(buffer) >= HISTORY_CHUNK_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+
+    buffer += b"]}"
+    yield bytes(buffer)
+
 @app.get("/history/{thread_id}")
 @limiter.limit("20/minute")
-def get_history(thread_id: str, request: Request):
-    global agent_app
-    try:
-        if len(thread_id) > 100:
-             raise HTTPException(status_code=422, detail="Thread ID too long")
+async def get_history(thread_id: str, request: Request):
+    agent = request.app.state.agent
+    # Reject malformed IDs before they cost a checkpoint query
+    if not THREAD_ID_RE.fullmatch(thread_id):
+        raise HTTPException(status_code=422, detail="Invalid thread_id")
 
+    try:
         config = {"configurable": {"thread_id": thread_id}}
-        state = agent_app.get_state(config)
-        
-        if not state.values:
-            return {"messages": []}
-            
-        formatted_messages = []
-        
-        for msg in state.values.get("messages", []):
-            msg_type = "user"
-            if isinstance(msg, AIMessage):
-                msg_type = "ai"
-            elif isinstance(msg, HumanMessage):
-                msg_type = "user"
-            else:
-                continue 
-            
-            content = msg.content
-            # Clean up System Injections
-            if msg_type == "user" and content.startswith("User ID:"):
-                # The content format is "User ID: 123\n\nActual Message"
-                # We split by the first double newline to get the real message
-                parts = content.split("\n\n", 1)
-                if len(parts) > 1:
-                    content = parts[1]
-                # If split fails, we keep original content (fallback)
-
-            formatted_messages.append({
-                "id": str(getattr(msg, "id", "")),
-                "type": msg_type,
-                "message": content,
-                "timestamp": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
-            })
-
-        return {"messages": formatted_messages}
-
+        state = await agent.aget_state(config)
     except Exception as e:
         print(f"⚠️ History Error: {e}")
         return {"messages": []}
 
+    messages = state.values.get("messages", []) if state.values else []
+    return StreamingResponse(iter_history_json(messages), media_type="application/json")
+
 if __name__ == "__main__":
     # RAILWAY REQUIREMENT:
     # Railway provides the PORT variable. If it's not found, default to 8001.
     port = int(os.getenv("PORT", 8001))
-    print(f"🚀 Starting Secure Server on port {port}...")
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    print(f"🚀 Starting Secure Server on port {port} with {WORKERS} workers...")
+    # Workers need an import string; uvloop/httptools are the faster loop and HTTP parser
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=port,
+        workers=WORKERS,
+        loop="uvloop",
+        http="httptools"
+    )
\ No newline at end of file